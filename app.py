@@ -1,33 +1,100 @@
+import os
+# 必须在导入numpy/CTranslate2之前设置：默认每个库都会按机器核数启动OpenMP线程，
+# 在只有1-2个vCPU的云实例上会严重超订。可在部署环境中通过环境变量覆盖。
+os.environ.setdefault('OMP_NUM_THREADS', '1')
+os.environ.setdefault('MKL_NUM_THREADS', '1')
+
 from flask import Flask, request, jsonify, send_from_directory
-import librosa
+from flask.json.provider import JSONProvider
+import orjson
 import numpy as np
-import soundfile as sf
-import io
-from pydub import AudioSegment
-import whisper # 导入Whisper
+import queue
+import subprocess
+import hashlib
+import threading
+from cachetools import TTLCache
+from numba import njit
+from faster_whisper import WhisperModel # 导入faster-whisper (CTranslate2后端)
+
+class OrjsonProvider(JSONProvider):
+    """
+    使用orjson替代标准库json进行序列化，jsonify直接输出orjson生成的bytes。
+    """
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(
+            orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY), mimetype="application/json"
+        )
 
 # 初始化Flask应用
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 
-# --- 核心改动：实现Whisper模型的懒加载 ---
-# 1. 初始化一个全局变量来存储模型，初始值为None
+# --- 核心改动：Whisper模型的加载与预热 ---
+# 1. 初始化一个全局变量来存储模型，初始值为None。
+#    部署时gunicorn_conf.py的post_fork钩子会在每个worker启动时调用get_whisper_model()预热，
+#    直接运行本模块(或不使用该配置)时，则在第一个请求中加载。
 model = None
+model_lock = threading.Lock()
+# Whisper推理使用的线程数，应与实例实际可用的CPU核数一致
+WHISPER_CPU_THREADS = int(os.environ.get('WHISPER_CPU_THREADS', '2'))
 
 def get_whisper_model():
     """
     此函数用于获取Whisper模型。
-    它会检查模型是否已经加载到内存中，如果没有，则进行加载。
-    这可以防止在应用启动时因加载模型过慢而导致部署超时。
+    它会检查模型是否已经加载到内存中，如果没有，则进行加载；加锁保证多线程下只加载一次。
+    生产环境中由gunicorn的post_fork钩子在worker启动时调用，把加载耗时放在启动阶段，
+    模型文件已在构建Docker镜像时下载好，因此这里只需从本地磁盘读取。
     """
     global model
-    if model is None:
+    with model_lock:
+        if model is not None:
+            return model
         print("Whisper model is not loaded. Loading now... (This may take a moment on the first run)")
         # 2. 如果模型未加载，则加载它。这步操作只会在第一次被调用时执行。
-        model = whisper.load_model("tiny.en")
+        #    使用int8量化的CTranslate2模型，CPU推理更快、内存占用更小。
+        model = WhisperModel(
+            "tiny.en", device="cpu", compute_type="int8",
+            cpu_threads=WHISPER_CPU_THREADS, num_workers=1,
+        )
         print("Whisper model loaded successfully.")
     return model
 # --- 改动结束 ---
 
+# 多线程worker下同时进行转写的请求数上限，用于控制内存占用；
+# 上传接收、解码和特征分析不受此限制，可以并发进行
+TRANSCRIBE_CONCURRENCY = int(os.environ.get('TRANSCRIBE_CONCURRENCY', '1'))
+transcribe_slots = threading.BoundedSemaphore(TRANSCRIBE_CONCURRENCY)
+
+# 分析结果缓存：以上传音频内容的哈希为键，重复上传(如用户重试)时直接返回结果
+result_cache = TTLCache(maxsize=512, ttl=3600)
+result_cache_lock = threading.Lock()
+
+# 风险评估阈值表：按语速(WPM)从高到低匹配，第一个满足 words_per_minute >= 阈值 的条目即为结果
+# 接口只返回简短的风险代码，对应的建议文字由前端页面根据代码显示
+RISK_TABLE = [
+    (140, 'LOW'),
+    (100, 'MED_RATE'),
+    (0, 'HIGH'),
+]
+RISK_LEVELS = {
+    'LOW': 'Low Risk',
+    'MED_RATE': 'Medium Risk',
+    'MED_PAUSE': 'Medium Risk',
+    'HIGH': 'High Risk',
+}
+# 每个风险代码对应的JSON片段在启动时预先序列化，请求中只需拼接
+RISK_PAYLOADS = {
+    code: orjson.dumps({"riskCode": code, "riskLevel": level})
+    for code, level in RISK_LEVELS.items()
+}
+
 
 # 使用Flask的after_request装饰器手动添加CORS头
 @app.after_request
@@ -37,23 +104,161 @@ def after_request(response):
     response.headers.add('Access-Control-Allow-Methods', 'GET,PUT,POST,DELETE,OPTIONS')
     return response
 
+# 直接调用ffmpeg解码为16kHz单声道float32 PCM，省去pydub转码和WAV封装
+SAMPLE_RATE = 16000
+# 与pydub一致使用cache:协议读取stdin，让需要回跳读取的格式(如索引在文件末尾的MP4/M4A)也能解码
+FFMPEG_CMD = [
+    'ffmpeg', '-v', 'quiet', '-read_ahead_limit', '-1', '-i', 'cache:pipe:0',
+    '-f', 'f32le', '-ar', str(SAMPLE_RATE), '-ac', '1', 'pipe:1',
+]
+
+# 预先启动的ffmpeg进程池：每个进程只处理一次输入，被取走后在后台补充新的进程，
+# 这样fork/exec的开销不会落在请求的关键路径上。
+# 每个worker同时最多解码threads个上传，默认值与gunicorn_conf.py中的threads保持一致
+FFMPEG_POOL_SIZE = int(os.environ.get('FFMPEG_POOL_SIZE', '4'))
+ffmpeg_pool = queue.Queue()
+
+def _spawn_ffmpeg():
+    return subprocess.Popen(FFMPEG_CMD, stdin=subprocess.PIPE, stdout=subprocess.PIPE, bufsize=1 << 20)
+
+def _refill_ffmpeg_pool():
+    ffmpeg_pool.put(_spawn_ffmpeg())
+
+def checkout_ffmpeg():
+    """
+    从进程池中取出一个可用的ffmpeg进程，并在后台补充一个新进程。
+    已经意外退出的进程会被丢弃；进程池暂时为空时直接新启动一个。
+    """
+    while True:
+        try:
+            proc = ffmpeg_pool.get_nowait()
+        except queue.Empty:
+            return _spawn_ffmpeg()
+        threading.Thread(target=_refill_ffmpeg_pool, daemon=True).start()
+        if proc.poll() is None:
+            return proc
+
+for _ in range(FFMPEG_POOL_SIZE):
+    _refill_ffmpeg_pool()
+
+def decode_audio(audio_bytes):
+    """
+    将上传的任意格式音频(webm, ogg, mp3等)通过ffmpeg管道解码为numpy数组。
+    返回的数组可直接同时用于Whisper转写和停顿分析。
+    """
+    proc = checkout_ffmpeg()
+    out, _ = proc.communicate(audio_bytes)
+    if proc.returncode != 0:
+        raise RuntimeError(f"ffmpeg exited with code {proc.returncode}")
+    return np.frombuffer(out, dtype=np.float32)
+
 # 添加一个路由来服务前端HTML页面
 @app.route('/')
 def serve_index():
     return send_from_directory('.', 'dementia_screening_demo.html')
 
-def analyze_audio_features(audio_data, sr_librosa):
-    non_silent_intervals = librosa.effects.split(audio_data, top_db=20)
-    pauses = []
-    for i in range(len(non_silent_intervals) - 1):
-        pause_start = non_silent_intervals[i][1] / sr_librosa
-        pause_end = non_silent_intervals[i+1][0] / sr_librosa
-        pause_duration = pause_end - pause_start
-        if pause_duration > 0.1:
-            pauses.append(pause_duration)
-    if not pauses:
-        return 0.0
-    return np.mean(pauses)
+def frame_energy(audio_data, frame_length=2048, hop_length=512):
+    """
+    计算每帧的能量(平方和)。帧长frame_length、帧移hop_length，
+    帧能量由平方和的累加和相减得到，每个样本只平方一次。
+    """
+    n_samples = len(audio_data)
+    # 直接把累加和写入预先分配好的数组，避免再拼接复制一份完整长度的float64数组
+    cumulative = np.empty(n_samples + 1, dtype=np.float64)
+    cumulative[0] = 0.0
+    np.cumsum(audio_data * audio_data, dtype=np.float64, out=cumulative[1:])
+    # 不足一帧的音频按补零后的一整帧处理
+    starts = np.arange(0, max(n_samples - frame_length, 0) + 1, hop_length)
+    return cumulative[np.minimum(starts + frame_length, n_samples)] - cumulative[starts]
+
+def split_non_silent(audio_data, top_db=20, frame_length=2048, hop_length=512, ref_rms=None, energy=None):
+    """
+    用NumPy按帧能量阈值查找非静音区间，作用同librosa.effects.split但完全向量化。
+    ref_rms为参考电平，默认取最响的一帧；传1.0则阈值按满刻度(dBFS)计算，不受个别响亮帧影响。
+    已经用frame_energy算好的帧能量可以通过energy传入，避免重复计算。
+    返回形状为(n, 2)的样本下标数组，每行是一个区间的[起点, 终点)。
+    """
+    n_samples = len(audio_data)
+    if n_samples == 0:
+        return np.empty((0, 2), dtype=np.int64)
+    if energy is None:
+        energy = frame_energy(audio_data, frame_length, hop_length)
+    # 帧能量低于参考能量top_db分贝以下的视为静音
+    ref_energy = energy.max() if ref_rms is None else ref_rms * ref_rms * frame_length
+    threshold = ref_energy * 10 ** (-top_db / 10)
+    mask = energy > threshold
+    # 在首尾补零后求差分，+1处为区间起点，-1处为区间终点
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], mask.astype(np.int8), [0]))))
+    intervals = edges.reshape(-1, 2) * hop_length
+    return np.minimum(intervals, n_samples)
+
+@njit(cache=True)
+def _mean_pause(intervals, sr):
+    # 由Numba编译为本地代码：求相邻非静音区间之间的停顿时长，只统计超过0.1秒的停顿
+    total = 0.0
+    count = 0
+    for i in range(intervals.shape[0] - 1):
+        pause = (intervals[i + 1, 0] - intervals[i, 1]) / sr
+        if pause > 0.1:
+            total += pause
+            count += 1
+    return total / count if count > 0 else 0.0
+
+# 导入时先用假数据调用一次，让编译(或读取磁盘缓存)发生在启动阶段而不是第一个请求里
+_mean_pause(np.zeros((2, 2), dtype=np.int64), float(SAMPLE_RATE))
+
+def analyze_audio_features(audio_data, sr_librosa, non_silent_intervals=None):
+    if non_silent_intervals is None:
+        non_silent_intervals = split_non_silent(audio_data, top_db=20)
+    return _mean_pause(non_silent_intervals.astype(np.int64, copy=False), float(sr_librosa))
+
+def speech_clip_timestamps(intervals, sr, total_duration, max_gap=2.0, padding=0.2):
+    """
+    将非静音区间转换为faster-whisper的clip_timestamps(秒)，作为廉价的能量VAD门控。
+    间隔短于max_gap秒的区间会被合并，避免把一句话切成许多过短的片段；
+    每段前后各留padding秒余量，防止截掉词首词尾。
+    """
+    iv = np.asarray(intervals)
+    if len(iv) == 0:
+        return []
+    breaks = np.flatnonzero(iv[1:, 0] - iv[:-1, 1] >= max_gap * sr)
+    starts = iv[np.concatenate(([0], breaks + 1)), 0] / sr - padding
+    ends = iv[np.concatenate((breaks, [len(iv) - 1])), 1] / sr + padding
+    clips = np.stack((np.maximum(starts, 0.0), np.minimum(ends, total_duration)), axis=1)
+    return clips.ravel().tolist()
+
+# 转写门控使用的绝对电平阈值：帧RMS低于-50 dBFS才视为静音。
+# 不能沿用停顿分析中相对最响帧20 dB的阈值，否则一次响亮的杂音就会让较轻的说话声被整段跳过。
+SPEECH_GATE_DBFS = -50
+
+def speech_intervals(audio_data, energy=None):
+    """
+    返回用于转写门控的有声区间(按绝对电平判断)，与停顿分析使用的区间相互独立。
+    """
+    return split_non_silent(audio_data, top_db=-SPEECH_GATE_DBFS, ref_rms=1.0, energy=energy)
+
+def transcribe_audio(audio_data, gate_intervals=None):
+    """
+    使用本地faster-whisper模型转写16kHz单声道音频，返回识别出的文本。
+    只把能量VAD判定为有声音的片段交给模型，长时间的静音不再参与解码；
+    整段都是静音时直接返回空字符串，不调用模型。
+    已经算好的门控区间(见speech_intervals)可以通过gate_intervals传入，避免重复计算。
+    """
+    if gate_intervals is None:
+        gate_intervals = speech_intervals(audio_data)
+    total_duration = len(audio_data) / SAMPLE_RATE
+    clip_timestamps = speech_clip_timestamps(gate_intervals, SAMPLE_RATE, total_duration)
+    if not clip_timestamps:
+        return ""
+    # 在需要模型时，调用get_whisper_model()
+    current_model = get_whisper_model()
+    with transcribe_slots:
+        # transcribe返回的是生成器，需要在占用名额期间完成迭代
+        segments, _ = current_model.transcribe(
+            audio_data, language="en", beam_size=1, vad_filter=False,
+            clip_timestamps=clip_timestamps,
+        )
+        return "".join(segment.text for segment in segments)
 
 @app.route('/analyze', methods=['POST'])
 def analyze():
@@ -63,65 +268,55 @@ def analyze():
     audio_file = request.files['audio']
     
     try:
-        audio_segment = AudioSegment.from_file(audio_file)
-        wav_io = io.BytesIO()
-        audio_segment.set_frame_rate(16000).set_channels(1).export(wav_io, format="wav")
-        wav_io.seek(0)
-        
-        with sf.SoundFile(wav_io, 'r') as sound_file:
-            audio_data_whisper = sound_file.read(dtype='float32')
-        
-        # --- 核心改动：调用函数来获取模型，而不是直接使用全局变量 ---
-        # 3. 在需要模型时，调用get_whisper_model()
-        current_model = get_whisper_model()
-        result = current_model.transcribe(audio_data_whisper, fp16=False)
-        transcript = result['text']
-        # --- 改动结束 ---
-            
-        word_count = len(transcript.split())
+        audio_bytes = audio_file.read()
+        cache_key = hashlib.blake2b(audio_bytes, digest_size=16).hexdigest()
+        with result_cache_lock:
+            cached = result_cache.get(cache_key)
+        if cached is not None:
+            return app.response_class(cached, mimetype="application/json")
 
-        wav_io.seek(0)
-        audio_data, sample_rate = sf.read(wav_io)
+        # 解码结果只有一份，转写门控和停顿分析共用同一个数组和同一次帧能量计算，
+        # 只是各自使用不同的静音阈值
+        audio_data = decode_audio(audio_bytes)
+        energy = frame_energy(audio_data)
+        non_silent_intervals = split_non_silent(audio_data, top_db=20, energy=energy)
         
-        if audio_data.ndim > 1:
-            audio_data = audio_data.mean(axis=1)
+        total_duration = len(audio_data) / SAMPLE_RATE
+        transcript = transcribe_audio(audio_data, speech_intervals(audio_data, energy))
+            
+        words = transcript.split()
+        word_count = len(words)
 
-        total_duration = librosa.get_duration(y=audio_data, sr=sample_rate)
-        
         duration_minutes = total_duration / 60
         if duration_minutes > 0:
             words_per_minute = round(word_count / duration_minutes)
         else:
             words_per_minute = 0
             
-        avg_pause_duration = analyze_audio_features(audio_data, sample_rate)
+        avg_pause_duration = analyze_audio_features(audio_data, SAMPLE_RATE, non_silent_intervals)
 
-        unique_words = len(set(transcript.lower().split()))
+        unique_words = len({word.lower() for word in words})
         lexical_richness = round((unique_words / word_count * 100), 1) if word_count > 0 else 0
 
         # 风险评估
-        risk = 'Low Risk'
-        risk_suggestion = 'All indicators are within the normal range. Please continue to maintain a healthy lifestyle.'
-
-        if words_per_minute < 140 and words_per_minute >= 100:
-            risk = 'Medium Risk'
-            risk_suggestion = 'Some indicators show slight abnormalities. We recommend that you keep monitoring and consider regular check-ups.'
-        elif words_per_minute < 100:
-            risk = 'High Risk'
-            risk_suggestion = 'Significant linguistic abnormalities have been detected. We strongly recommend consulting a doctor for a comprehensive evaluation.'
+        for wpm_threshold, risk_code in RISK_TABLE:
+            if words_per_minute >= wpm_threshold:
+                break
         
-        if avg_pause_duration > 0.9 and risk == 'Low Risk':
-            risk = 'Medium Risk'
-            risk_suggestion = 'Your speaking rate is normal, but with slightly longer pauses. We recommend that you keep monitoring and consider regular check-ups.'
+        if avg_pause_duration > 0.9 and risk_code == 'LOW':
+            risk_code = 'MED_PAUSE'
 
-        return jsonify({
+        metrics = orjson.dumps({
             "speakingRate": f"{words_per_minute} WPM",
             "pauseDuration": f"{avg_pause_duration:.2f} s",
             "lexicalRichness": f"{lexical_richness}%",
-            "riskLevel": risk,
-            "suggestion": risk_suggestion,
             "transcript": transcript
         })
+        # 把动态指标和预先序列化好的风险片段拼接成一个JSON对象: {...指标, ...风险}
+        analysis = metrics[:-1] + b"," + RISK_PAYLOADS[risk_code][1:]
+        with result_cache_lock:
+            result_cache[cache_key] = analysis
+        return app.response_class(analysis, mimetype="application/json")
 
     except Exception as e:
         print(f"An error occurred during analysis: {e}")
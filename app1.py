@@ -1,12 +1,12 @@
+# 复用app.py中的ffmpeg解码、静音检测、停顿分析和本地Whisper转写。
+# 必须最先导入app：它会在numpy等库加载之前设置OMP_NUM_THREADS/MKL_NUM_THREADS的默认值
+from app import (
+    SAMPLE_RATE, analyze_audio_features, decode_audio, frame_energy,
+    split_non_silent, speech_intervals, transcribe_audio,
+)
 from flask import Flask, request, jsonify
 # 我们不再需要 flask_cors, 所以可以移除这个导入
 # from flask_cors import CORS
-import speech_recognition as sr
-import librosa
-import numpy as np
-import soundfile as sf
-import io
-from pydub import AudioSegment
 
 # 初始化Flask应用
 app = Flask(__name__)
@@ -25,35 +25,6 @@ def after_request(response):
 # --- 改动结束 ---
 
 
-# 用于语音识别的识别器实例
-r = sr.Recognizer()
-
-def analyze_audio_features(audio_data, sr_librosa):
-    """
-    使用Librosa分析音频特征
-    :param audio_data: 音频数据 (numpy array)
-    :param sr_librosa: 采样率
-    :return: 平均停顿时长
-    """
-    # 查找非静音部分
-    non_silent_intervals = librosa.effects.split(audio_data, top_db=20)
-    
-    pauses = []
-    # 计算每次停顿的持续时间
-    for i in range(len(non_silent_intervals) - 1):
-        pause_start = non_silent_intervals[i][1] / sr_librosa
-        pause_end = non_silent_intervals[i+1][0] / sr_librosa
-        pause_duration = pause_end - pause_start
-        if pause_duration > 0.1: # 只考虑超过0.1秒的停顿
-            pauses.append(pause_duration)
-            
-    if not pauses:
-        return 0.0
-
-    # 返回平均停顿时长
-    return np.mean(pauses)
-
-
 @app.route('/analyze', methods=['POST'])
 def analyze():
     # 检查请求中是否包含文件
@@ -63,35 +34,23 @@ def analyze():
     audio_file = request.files['audio']
     
     try:
-        # --- 核心改动：将传入的音频转换为WAV格式 ---
-        # pydub可以自动识别传入的音频格式 (webm, ogg, mp3等)
-        audio_segment = AudioSegment.from_file(audio_file)
-        
-        # 创建一个内存中的WAV文件对象
-        wav_io = io.BytesIO()
-        audio_segment.export(wav_io, format="wav")
-        wav_io.seek(0) # 重置指针到文件开头
+        # --- 核心改动：用ffmpeg直接解码为16kHz单声道float32 PCM，不再经过WAV封装 ---
+        # ffmpeg可以自动识别传入的音频格式 (webm, ogg, mp3等)
+        audio_data = decode_audio(audio_file.read())
+        # 转写门控和停顿分析共用同一次帧能量计算
+        energy = frame_energy(audio_data)
+        non_silent_intervals = split_non_silent(audio_data, top_db=20, energy=energy)
         # --- 转换完成 ---
 
-        # --- 语音转文字 (现在使用转换后的WAV文件) ---
-        with sr.AudioFile(wav_io) as source:
-            audio_data_sr = r.record(source)
-            # 使用 Whisper API (需要联网) 或本地Whisper模型进行识别
-            # 这里使用Google的API作为示例, 您可以换成recognize_whisper
-            transcript = r.recognize_google(audio_data_sr, language='en-US')
+        # --- 语音转文字 (使用本地faster-whisper模型, 无需联网) ---
+        transcript = transcribe_audio(audio_data, speech_intervals(audio_data, energy))
             
-        word_count = len(transcript.split())
-
-        # --- 语音特征分析 (Librosa) ---
-        # 为了让Librosa也能处理, 再次重置指针
-        wav_io.seek(0)
-        audio_data, sample_rate = sf.read(wav_io)
-        
-        # 如果是多声道, 转为单声道
-        if audio_data.ndim > 1:
-            audio_data = audio_data.mean(axis=1)
+        words = transcript.split()
+        word_count = len(words)
 
-        total_duration = librosa.get_duration(y=audio_data, sr=sample_rate)
+        # --- 语音特征分析 ---
+        # 与识别共用同一份解码结果, 无需再次读取
+        total_duration = len(audio_data) / SAMPLE_RATE
         
         # 计算语速 (WPM)
         duration_minutes = total_duration / 60
@@ -101,10 +60,10 @@ def analyze():
             words_per_minute = 0
             
         # 分析停顿
-        avg_pause_duration = analyze_audio_features(audio_data, sample_rate)
+        avg_pause_duration = analyze_audio_features(audio_data, SAMPLE_RATE, non_silent_intervals)
 
         # 词汇丰富度
-        unique_words = len(set(transcript.lower().split()))
+        unique_words = len({word.lower() for word in words})
         lexical_richness = round((unique_words / word_count * 100), 1) if word_count > 0 else 0
 
 
@@ -134,10 +93,6 @@ def analyze():
             "transcript": transcript # 附上识别的文本
         })
 
-    except sr.UnknownValueError:
-        return jsonify({"error": "Speech recognition could not understand audio"}), 400
-    except sr.RequestError as e:
-        return jsonify({"error": f"Speech recognition service error; {e}"}), 500
     except Exception as e:
         print(f"An error occurred: {e}")
         return jsonify({"error": "An internal error occurred"}), 500
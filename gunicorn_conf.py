@@ -0,0 +1,26 @@
+# Gunicorn配置文件：在Dockerfile中通过 gunicorn -c gunicorn_conf.py app:app 加载
+
+bind = "0.0.0.0:10000"
+
+# 使用gthread多线程worker，转写等阻塞在C扩展中的工作会释放GIL，多个上传可以并发处理
+worker_class = "gthread"
+# app.py中的FFMPEG_POOL_SIZE默认与此相同，修改时请一并调整
+threads = 4
+
+# worker超时时间(秒)。post_fork中的预热在worker开始向arbiter发送心跳之前执行，
+# 因此模型加载必须在这个时间内完成，否则worker会被杀掉并反复重启。
+# 模型文件在构建Docker镜像时已经下载(见Dockerfile)，这里只需从磁盘加载tiny.en，
+# 通常只要几秒；120秒留给慢速磁盘和Numba首次编译等启动开销。
+# 如果不使用该镜像、需要在启动时联网下载模型，请相应调大此值。
+timeout = 120
+
+
+def post_fork(server, worker):
+    """
+    worker进程fork之后立即预热：加载Whisper模型并启动ffmpeg进程池，
+    把冷启动的耗时放在启动阶段，而不是落在第一个用户请求上。
+    """
+    # 导入app时会填充ffmpeg进程池，同时把ffmpeg可执行文件读入系统页缓存
+    from app import get_whisper_model
+    get_whisper_model()
+    server.log.info("Worker %s warmed up (Whisper model and ffmpeg pool ready)", worker.pid)